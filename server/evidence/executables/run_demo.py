@@ -4,6 +4,7 @@ run_demo.py
 One-file, judge-ready demo runner.
 
 - Starts a pure-Python TCP replay server over datasets in ./data/input/
+  (uses orjson for frame encode/decode when installed, stdlib json otherwise)
 - Runs a pure-Python consumer that performs BasketProof™ fusion
 - Writes ./results/events.jsonl (judge-friendly JSONL)
 
@@ -15,18 +16,28 @@ Optional:
 
 from __future__ import annotations
 import argparse
+import atexit
 import csv
 import json
 import logging
+import operator
 import os
 import re
 import socket
 import socketserver
+import sys
 import threading
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
 from pathlib import Path
-from typing import Iterable, List, Dict, Any, Optional
+from typing import Iterable, Iterator, List, Dict, Any, Optional
+
+try:
+    import orjson
+except ImportError:  # optional speedup; stdlib json is the fallback
+    orjson = None
 
 # ----------------------------
 # Paths & defaults
@@ -40,6 +51,8 @@ TCP_HOST = "127.0.0.1"
 TCP_PORT = 8765
 SPEED = 25.0  # accelerated replay
 LOOP = False  # single pass only (judges want a complete run then exit)
+FLUSH_BYTES = 32 * 1024  # coalesce frames into one sendall up to this size
+FLUSH_GAP_S = 0.01  # ...but never hold buffered frames across a longer pause
 
 DATASETS = [
     "POS_Transactions",
@@ -52,8 +65,37 @@ DATASETS = [
 # ----------------------------
 # Helpers
 # ----------------------------
+_iso_cache = [-1, ""]  # [epoch second, formatted timestamp]
+
 def iso_now():
-    return datetime.now(timezone.utc).replace(microsecond=0).isoformat()
+    # Second resolution, so the formatted string is reused within a second.
+    now = int(time.time())
+    if now != _iso_cache[0]:
+        _iso_cache[:] = [now, datetime.fromtimestamp(now, timezone.utc).isoformat()]
+    return _iso_cache[1]
+
+def dumps(obj) -> bytes:
+    """Serialize to compact UTF-8 JSON bytes (orjson when available)."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+def loads(raw):
+    """Parse JSON from str or bytes (orjson when available)."""
+    if orjson is not None:
+        return orjson.loads(raw)
+    if isinstance(raw, (bytes, bytearray)):
+        # Match orjson: bad UTF-8 must not escape as UnicodeDecodeError.
+        raw = raw.decode("utf-8", errors="ignore")
+    return json.loads(raw)
+
+def to_float_or_none(value) -> Optional[float]:
+    if value is None or type(value) is float:
+        return value
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
 
 def die(msg: str, code: int = 1):
     print(f"[run_demo] ERROR: {msg}")
@@ -71,6 +113,14 @@ DATASET_ALIASES: Dict[str, str] = {
     "Current_inventory_data": "inventory_snapshots",
 }
 FILENAME_TO_CANONICAL: Dict[str, str] = {v: k for k, v in DATASET_ALIASES.items()}
+# Small-int dataset ids sent as "dataset_tag" so the consumer can dispatch without string scans.
+DATASET_TAGS: Dict[str, int] = {
+    "POS_Transactions": 0,
+    "RFID_data": 1,
+    "Product_recognism": 2,
+    "Queue_monitor": 3,
+    "Current_inventory_data": 4,
+}
 EXCLUDE_DATASETS = {"events"}
 
 def resolve_dataset_path(data_root: Path, name: str) -> Path:
@@ -92,20 +142,29 @@ def resolve_dataset_path(data_root: Path, name: str) -> Path:
     attempted = ", ".join(str(path) for path in candidates)
     raise SystemExit(f"Dataset file not found. Tried: {attempted}")
 
-def load_events(dataset_path: Path) -> List[Dict[str, Any]]:
-    with dataset_path.open("r", encoding="utf-8") as handle:
+def load_events(dataset_path: Path) -> Iterator[Dict[str, Any]]:
+    # JSONL is streamed a line at a time so the whole file is never held as one buffer.
+    if dataset_path.suffix == ".jsonl":
+        with dataset_path.open("rb") as handle:
+            for line in handle:
+                if line.strip():
+                    yield loads(line)
+        return
+    with dataset_path.open("rb") as handle:
         try:
-            payload = json.load(handle)
+            payload = loads(handle.read())
         except json.JSONDecodeError:
             handle.seek(0)
-            payload = [json.loads(line) for line in handle if line.strip()]
+            payload = [loads(line) for line in handle if line.strip()]
     if isinstance(payload, list):
-        return payload
-    if isinstance(payload, dict):
+        yield from payload
+    elif isinstance(payload, dict):
         if "events" in payload and isinstance(payload["events"], list):
-            return payload["events"]
-        return [payload]
-    raise ValueError(f"Unsupported JSON structure in {dataset_path}.")
+            yield from payload["events"]
+        else:
+            yield payload
+    else:
+        raise ValueError(f"Unsupported JSON structure in {dataset_path}.")
 
 def parse_timestamp(value: Any, dataset: str, source: Path) -> datetime:
     if not isinstance(value, str):
@@ -115,21 +174,60 @@ def parse_timestamp(value: Any, dataset: str, source: Path) -> datetime:
     except ValueError as exc:
         raise ValueError(f"Unable to parse timestamp '{value}' in {dataset} ({source})") from exc
 
+_ONE_US = timedelta(microseconds=1)
+_TS_SLOT = "\x01ts\x01"  # placeholder spliced out of the serialized event
+
+def frame_template(dataset: str, event: Dict[str, Any]) -> bytes:
+    """Pre-serialize a replay frame as a bytes %-template.
+
+    Only the sequence number and the adjusted timestamp change between
+    sends, so the frame is encoded once at load time and filled in with
+    ``template % (sequence, iso, iso)``.
+    """
+    slot = dumps(_TS_SLOT)
+    ev_parts = dumps({**event, "timestamp": _TS_SLOT}).split(slot)
+    if len(ev_parts) != 2:
+        raise ValueError(f"Event in {dataset} cannot be templated: {event!r}")
+    head = b'{"dataset":' + dumps(dataset) + b',"dataset_tag":' + dumps(DATASET_TAGS.get(dataset))
+    orig = b',"original_timestamp":' + dumps(event.get("timestamp"))
+    head, orig, ev_head, ev_tail = (
+        part.replace(b"%", b"%%") for part in (head, orig, *ev_parts)
+    )
+    return (head + b',"sequence":%d,"timestamp":"%s"' + orig
+            + b',"event":' + ev_head + b'"%s"' + ev_tail + b"}\n")
+
 def collect_events(dataset_paths: Iterable[Path]) -> tuple[List[Dict[str, Any]], List[str]]:
     all_events: List[Dict[str, Any]] = []
     dataset_names: List[str] = []
+    # Streams repeat timestamps heavily (one tick per station), so parse each string once.
+    parsed: Dict[str, datetime] = {}
     for path in dataset_paths:
         dataset_name = FILENAME_TO_CANONICAL.get(path.stem, path.stem)
         dataset_names.append(dataset_name)
-        raw_events = load_events(path)
-        if not raw_events:
-            continue
-        for event in raw_events:
-            ts = parse_timestamp(event.get("timestamp"), dataset_name, path)
-            all_events.append({"dataset": dataset_name, "timestamp": ts, "payload": event})
+        for event in load_events(path):
+            raw_ts = event.get("timestamp")
+            ts = parsed.get(raw_ts) if isinstance(raw_ts, str) else None
+            if ts is None:
+                ts = parsed[raw_ts] = parse_timestamp(raw_ts, dataset_name, path)
+            all_events.append({
+                "dataset": dataset_name,
+                "timestamp": ts,
+                "template": frame_template(dataset_name, event),
+            })
     if not all_events:
         raise ValueError("No events found across provided datasets.")
-    all_events.sort(key=lambda item: item["timestamp"])
+    all_events.sort(key=operator.itemgetter("timestamp"))
+    # Integer offsets and formatted timestamps keep datetime math out of the replay loop.
+    t0 = all_events[0]["timestamp"]
+    # Aware datetimes for the same instant compare equal across UTC offsets, so the
+    # cache key keeps the offset to format each record in its own zone.
+    offsets: Dict[tuple, tuple[int, bytes]] = {}
+    for record in all_events:
+        ts = record["timestamp"]
+        key = record["ts_key"] = (ts, ts.utcoffset())
+        if key not in offsets:
+            offsets[key] = ((ts - t0) // _ONE_US * 1000, ts.isoformat().encode("ascii"))
+        record["ns_offset"], record["iso"] = offsets[key]
     return all_events, dataset_names
 
 class EventStreamRequestHandler(socketserver.BaseRequestHandler):
@@ -137,6 +235,7 @@ class EventStreamRequestHandler(socketserver.BaseRequestHandler):
         server: ReplayTCPServer = self.server  # type: ignore[assignment]
         client_host, client_port = self.client_address
         logging.info("Client connected from %s:%s", client_host, client_port)
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
         # banner
         banner = {
@@ -148,39 +247,50 @@ class EventStreamRequestHandler(socketserver.BaseRequestHandler):
             "cycle_seconds": server.cycle_span.total_seconds(),
             "schema": "newline-delimited JSON objects",
         }
-        self.request.sendall(json.dumps(banner).encode("utf-8") + b"\n")
+        self.request.sendall(dumps(banner) + b"\n")
 
         try:
             loop_index = 0
-            prev: Optional[datetime] = None
+            prev_ns: Optional[int] = None
+            cycle_ns = server.cycle_span // _ONE_US * 1000
             sequence = 1
+            buf = bytearray()
             # Single or looping
             while True:
                 logging.info("Starting replay cycle %d", loop_index + 1)
+                shift = server.cycle_span * loop_index
+                shifted_iso: Dict[tuple, bytes] = {}  # ts_key -> formatted timestamp for this cycle
+                base_ns = cycle_ns * loop_index
                 for record in server.events:
-                    adjusted: datetime = record["timestamp"] + (server.cycle_span * loop_index)
-                    if prev is not None:
-                        delta_s = (adjusted - prev).total_seconds()
+                    t_ns = record["ns_offset"] + base_ns
+                    if prev_ns is not None:
+                        delta_s = (t_ns - prev_ns) / 1e9
                         gap = (delta_s / server.speed) if server.speed > 0 else 0
                         if gap <= 0:
                             gap = 0.1 / max(1.0, server.speed)
+                        if buf and gap > FLUSH_GAP_S:
+                            self.request.sendall(buf)
+                            buf.clear()
                         time.sleep(gap)
-                    prev = adjusted
-
-                    original_timestamp = record["payload"].get("timestamp")
-                    event_copy = dict(record["payload"])
-                    event_copy["timestamp"] = adjusted.isoformat()
-
-                    frame = {
-                        "dataset": record["dataset"],
-                        "sequence": sequence,
-                        "timestamp": adjusted.isoformat(),
-                        "original_timestamp": original_timestamp,
-                        "event": event_copy,
-                    }
-                    self.request.sendall(json.dumps(frame).encode("utf-8") + b"\n")
+                    prev_ns = t_ns
+
+                    if not loop_index:
+                        iso = record["iso"]
+                    else:
+                        iso = shifted_iso.get(record["ts_key"])
+                        if iso is None:
+                            iso = (record["timestamp"] + shift).isoformat().encode("ascii")
+                            shifted_iso[record["ts_key"]] = iso
+                    buf += record["template"] % (sequence, iso, iso)
+                    if len(buf) >= FLUSH_BYTES:
+                        self.request.sendall(buf)
+                        buf.clear()
                     sequence += 1
 
+                if buf:
+                    self.request.sendall(buf)
+                    buf.clear()
+
                 if not server.loop:
                     logging.info("Loop disabled, ending stream")
                     break
@@ -191,8 +301,10 @@ class EventStreamRequestHandler(socketserver.BaseRequestHandler):
         finally:
             logging.info("Stream to %s:%s ended", client_host, client_port)
 
-class ReplayTCPServer(socketserver.ThreadingTCPServer):
+class ReplayTCPServer(socketserver.TCPServer):
     allow_reuse_address = True
+    max_workers = 8  # concurrent streams; further clients are refused
+
     def __init__(self, addr, events, dataset_names, speed, loop, cycle_span):
         super().__init__(addr, EventStreamRequestHandler)
         self.events = list(events)
@@ -200,6 +312,31 @@ class ReplayTCPServer(socketserver.ThreadingTCPServer):
         self.speed = speed
         self.loop = loop
         self.cycle_span = cycle_span
+        self._pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="replay")
+        self._slots = threading.BoundedSemaphore(self.max_workers)
+
+    def process_request(self, request, client_address):
+        # Reuse pooled workers instead of spawning a thread per connection. Looped streams
+        # never end, so a queued client would wait forever: refuse it instead.
+        if not self._slots.acquire(blocking=False):
+            logging.warning("All %d stream workers busy, closing connection from %s:%s",
+                            self.max_workers, *client_address[:2])
+            self.shutdown_request(request)
+            return
+        self._pool.submit(self._process_request_worker, request, client_address)
+
+    def _process_request_worker(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self._slots.release()
+
+    def server_close(self):
+        super().server_close()
+        self._pool.shutdown(wait=False)
 
 def start_server(host, port, data_root: Path, datasets: List[str], speed: float, loop: bool) -> ReplayTCPServer:
     if not data_root.exists():
@@ -230,6 +367,50 @@ def start_server(host, port, data_root: Path, datasets: List[str], speed: float,
 # ----------------------------
 # Part 2: Consumer (fusion + mapper)
 # ----------------------------
+# Fusion reason codes: compute() emits (code, detail) pairs, Mapper dispatches on code.
+# detail carries only what a writer needs beyond last_pos, or None.
+REASON_SCAN_AVOIDANCE = 0
+REASON_RFID_IN_BAG = 1
+REASON_BARCODE_SWITCH = 2
+REASON_WEIGHT_DELTA = 3
+REASON_QUEUE_PRESSURE = 4
+
+STATUS_RE = re.compile(r"Crash|Read Error|Failure", re.IGNORECASE)
+
+def _pos_key(data):
+    return data.get("sku")
+
+def _inbag_key(data):
+    return data.get("sku") if str(data.get("location", "")).upper().startswith("IN") else None
+
+def _push_window(window: deque, counts: Dict[str, int], data, key) -> None:
+    """Append to a bounded window, keeping a per-key count of its contents in sync."""
+    if len(window) == window.maxlen:
+        old = key(window[0])
+        if old:
+            if counts[old] == 1:
+                del counts[old]
+            else:
+                counts[old] -= 1
+    window.append(data)
+    new = key(data)
+    if new:
+        counts[new] = counts.get(new, 0) + 1
+
+class Station:
+    """Per-station fusion state: bounded sensor windows plus derived SKU counts."""
+    __slots__ = ("pos", "rfid", "vision", "pos_skus", "rfid_inbag_skus", "queue", "score", "reasons")
+
+    def __init__(self):
+        self.pos = deque(maxlen=10)
+        self.rfid = deque(maxlen=20)
+        self.vision = deque(maxlen=10)
+        self.pos_skus: Dict[str, int] = {}  # sku -> count within the pos window
+        self.rfid_inbag_skus: Dict[str, int] = {}  # sku -> in-bag reads within the rfid window
+        self.queue: Dict[str, Any] = {}
+        self.score = 0.0
+        self.reasons: list = []
+
 class FusionEngine:
     """
     @algorithm BasketProof | Multi-sensor consensus scoring
@@ -237,7 +418,7 @@ class FusionEngine:
     def __init__(self, products_csv: Path, vision_conf=0.85, weight_tol_pct=0.07):
         self.vision_conf = vision_conf
         self.weight_tol_pct = weight_tol_pct
-        self.state = {}  # station -> {pos:[], rfid:[], vision:[], queue:{}, score, reasons}
+        self.state: Dict[str, Station] = {}
         self.weights = self._load_weights(products_csv)
 
     def _load_weights(self, path: Path):
@@ -247,117 +428,119 @@ class FusionEngine:
                 rdr = csv.DictReader(f)
                 for row in rdr:
                     sku = row.get("SKU") or row.get("sku")
-                    w = row.get("weight_g") or row.get("Weight") or row.get("weight")
-                    if sku and w:
-                        try:
-                            weights[sku] = float(w)
-                        except:
-                            pass
+                    w = to_float_or_none(row.get("weight_g") or row.get("Weight") or row.get("weight"))
+                    if sku and w is not None:
+                        weights[sku] = w
         except Exception:
             pass
         return weights
 
     def _get(self, st):
-        if st not in self.state:
-            self.state[st] = {"pos": [], "rfid": [], "vision": [], "queue": {}, "score": 0.0, "reasons": []}
-        return self.state[st]
+        s = self.state.get(st)
+        if s is None:
+            s = self.state[st] = Station()
+        return s
 
     def last_pos(self, st):
         s = self._get(st)
-        return s["pos"][-1] if s["pos"] else None
+        return s.pos[-1] if s.pos else None
 
     def get_queue(self, st):
-        return self._get(st)["queue"]
+        return self._get(st).queue
 
     def push_pos(self, st, data, status=None):
         s = self._get(st)
-        s["pos"].append(data)
-        if len(s["pos"]) > 10:
-            s["pos"].pop(0)
-        if data.get("sku"):
-            exp = self.weights.get(data["sku"])
-            try:
-                if exp is not None:
-                    data["expected_weight"] = float(exp)
-            except Exception:
-                pass
+        _push_window(s.pos, s.pos_skus, data, _pos_key)
+        # Catalog weights are floats already; stamp once so compute() never consults the catalog.
+        exp = self.weights.get(data.get("sku"))
+        if exp is not None:
+            data["expected_weight"] = exp
 
     def push_rfid(self, st, data):
         # ignore null-only frames
         if not any((data.get("sku"), data.get("epc"), data.get("location"))):
             return
         s = self._get(st)
-        s["rfid"].append(data)
-        if len(s["rfid"]) > 20:
-            s["rfid"].pop(0)
+        _push_window(s.rfid, s.rfid_inbag_skus, data, _inbag_key)
 
     def push_vision(self, st, data, status=None):
         if not data.get("predicted_product"):
             return
         s = self._get(st)
-        s["vision"].append(data)
-        if len(s["vision"]) > 10:
-            s["vision"].pop(0)
+        s.vision.append(data)
 
     def set_queue(self, st, q):
-        self._get(st)["queue"] = q or {}
+        self._get(st).queue = q or {}
 
     def compute(self, st):
         s = self._get(st)
         score = 0.0
         reasons = []
 
-        v = s["vision"][-1] if s["vision"] else None
-        p = s["pos"][-1] if s["pos"] else None
+        v = s.vision[-1] if s.vision else None
+        p = s.pos[-1] if s.pos else None
+        v_sku = v.get("predicted_product") if v else None
+        p_sku = p.get("sku") if p else None
 
         # 1) scan avoidance
-        if v and v.get("predicted_product") and float(v.get("accuracy", 0.0)) >= self.vision_conf:
-            seen_in_pos = any(x.get("sku") == v["predicted_product"] for x in s["pos"])
-            if not seen_in_pos:
-                score += 0.40
-                reasons.append(f"Vision {v['predicted_product']}@{float(v.get('accuracy',0.0)):.2f} not in POS")
-                in_bag = any(
-                    (r.get("sku") == v["predicted_product"]) and str(r.get("location","")).upper().startswith("IN")
-                    for r in s["rfid"]
-                )
-                if in_bag:
-                    score += 0.20
-                    reasons.append("RFID in scan/bag area for vision SKU")
+        if v_sku:
+            accuracy = v.get("accuracy") or 0.0
+            if accuracy >= self.vision_conf:
+                if v_sku not in s.pos_skus:
+                    score += 0.40
+                    reasons.append((REASON_SCAN_AVOIDANCE, {"sku": v_sku}))
+                    if v_sku in s.rfid_inbag_skus:
+                        score += 0.20
+                        reasons.append((REASON_RFID_IN_BAG, {"sku": v_sku}))
 
         # 2) barcode switching
-        if v and v.get("predicted_product") and p and p.get("sku") and v["predicted_product"] != p["sku"]:
+        if v_sku and p_sku and v_sku != p_sku:
             score += 0.30
-            reasons.append(f"Vision {v['predicted_product']} ≠ POS {p['sku']}")
+            reasons.append((REASON_BARCODE_SWITCH, {"actual_sku": v_sku}))
 
         # 3) weight discrepancy
-        if p and (p.get("weight_g") is not None):
-            try:
-                observed = float(p["weight_g"])
-                expected = float(p.get("expected_weight") or self.weights.get(p["sku"]) or observed)
-                tol = self.weight_tol_pct * expected
-                if abs(observed - expected) > tol:
-                    score += 0.25
-                    reasons.append(f"Weight delta {observed-expected:.0f}g (obs={observed}, exp={expected})")
-            except Exception:
-                pass
+        if p:
+            expected = p.get("expected_weight")
+            observed = p.get("weight_g")
+            if expected and observed is not None and abs(observed - expected) > self.weight_tol_pct * expected:
+                score += 0.25
+                reasons.append((REASON_WEIGHT_DELTA, None))
 
         # 4) queue bump
-        q = s.get("queue") or {}
+        q = s.queue or {}
         if (q.get("customer_count", 0) >= 6) or (q.get("average_dwell_time", 0) >= 120):
             score += 0.05
-            reasons.append("High queue pressure")
+            reasons.append((REASON_QUEUE_PRESSURE, None))
 
-        s["score"] = max(0.0, min(1.0, score))
-        s["reasons"] = reasons
-        return {"score": s["score"], "reasons": reasons}
+        s.score = max(0.0, min(1.0, score))
+        s.reasons = reasons
+        return {"score": s.score, "reasons": reasons}
 
 class Mapper:
     """Writes judge-friendly events.jsonl lines."""
     def __init__(self, out_path: Path):
         self.out_path = out_path
         self.out_path.parent.mkdir(parents=True, exist_ok=True)
-        self._fh = open(self.out_path, "w", encoding="utf-8")
+        self._fh = open(self.out_path, "wb", buffering=1 << 16)
         self._counter = 0
+        self._pending: List[bytes] = []  # encoded lines awaiting flush_batch()
+        self._reason_writers = {
+            REASON_SCAN_AVOIDANCE: self._write_scan_avoidance,
+            REASON_BARCODE_SWITCH: self._write_barcode_switch,
+            REASON_WEIGHT_DELTA: self._write_weight_delta,
+        }
+        atexit.register(self.close)
+
+    def close(self):
+        atexit.unregister(self.close)
+        if not self._fh.closed:
+            self.flush_batch()
+            self._fh.close()
+
+    def flush_batch(self):
+        if self._pending:
+            self._fh.writelines(self._pending)
+            self._pending.clear()
 
     def _next_id(self):
         eid = f"E{self._counter:03d}"
@@ -365,57 +548,59 @@ class Mapper:
         return eid
 
     def _write(self, payload: dict):
-        self._fh.write(json.dumps(payload, ensure_ascii=False) + "\n")
-        self._fh.flush()
+        self._pending.append(dumps(payload) + b"\n")
 
     def from_fusion(self, station_id, fusion_result, last_pos):
         ts = iso_now()
-        reasons = fusion_result.get("reasons") or []
-        for r in reasons:
-            # Scanner Avoidance
-            if r.startswith("Vision") and "not in POS" in r:
-                self._write({
-                    "timestamp": ts,
-                    "event_id": self._next_id(),
-                    "event_data": {
-                        "event_name": "Scanner Avoidance",
-                        "station_id": station_id,
-                        "customer_id": last_pos.get("customer_id") if last_pos else None,
-                        "product_sku": (last_pos or {}).get("sku") or self._parse_sku(r)
-                    }
-                })
-            # Barcode Switching
-            if r.startswith("Vision") and "≠ POS" in r:
-                self._write({
-                    "timestamp": ts,
-                    "event_id": self._next_id(),
-                    "event_data": {
-                        "event_name": "Barcode Switching",
-                        "station_id": station_id,
-                        "customer_id": last_pos.get("customer_id") if last_pos else None,
-                        "actual_sku": self._parse_sku(r, "Vision"),
-                        "scanned_sku": (last_pos or {}).get("sku")
-                    }
-                })
-            # Weight Discrepancies
-            if r.startswith("Weight delta"):
-                self._write({
-                    "timestamp": ts,
-                    "event_id": self._next_id(),
-                    "event_data": {
-                        "event_name": "Weight Discrepancies",
-                        "station_id": station_id,
-                        "customer_id": last_pos.get("customer_id") if last_pos else None,
-                        "product_sku": (last_pos or {}).get("sku"),
-                        "expected_weight": (last_pos or {}).get("expected_weight"),
-                        "actual_weight": (last_pos or {}).get("weight_g")
-                    }
-                })
+        last_pos = last_pos or {}
+        for code, detail in fusion_result.get("reasons") or []:
+            writer = self._reason_writers.get(code)
+            if writer is not None:
+                writer(ts, station_id, detail, last_pos)
+
+    def _write_scan_avoidance(self, ts, station_id, detail, last_pos):
+        self._write({
+            "timestamp": ts,
+            "event_id": self._next_id(),
+            "event_data": {
+                "event_name": "Scanner Avoidance",
+                "station_id": station_id,
+                "customer_id": last_pos.get("customer_id"),
+                "product_sku": last_pos.get("sku") or detail.get("sku")
+            }
+        })
+
+    def _write_barcode_switch(self, ts, station_id, detail, last_pos):
+        self._write({
+            "timestamp": ts,
+            "event_id": self._next_id(),
+            "event_data": {
+                "event_name": "Barcode Switching",
+                "station_id": station_id,
+                "customer_id": last_pos.get("customer_id"),
+                "actual_sku": detail.get("actual_sku"),
+                "scanned_sku": last_pos.get("sku")
+            }
+        })
+
+    def _write_weight_delta(self, ts, station_id, detail, last_pos):
+        self._write({
+            "timestamp": ts,
+            "event_id": self._next_id(),
+            "event_data": {
+                "event_name": "Weight Discrepancies",
+                "station_id": station_id,
+                "customer_id": last_pos.get("customer_id"),
+                "product_sku": last_pos.get("sku"),
+                "expected_weight": last_pos.get("expected_weight"),
+                "actual_weight": last_pos.get("weight_g")
+            }
+        })
 
     def maybe_status(self, station_id, dataset_name, status):
         if not status:
             return
-        if re.search(r"(Crash|Read Error|Failure)", str(status), flags=re.IGNORECASE):
+        if STATUS_RE.search(str(status)):
             self._write({
                 "timestamp": iso_now(),
                 "event_id": self._next_id(),
@@ -431,10 +616,11 @@ class Mapper:
             return
         cc = queue.get("customer_count") or 0
         dt = queue.get("average_dwell_time") or 0
+        ts = iso_now()
 
         if cc >= 6:
             self._write({
-                "timestamp": iso_now(),
+                "timestamp": ts,
                 "event_id": self._next_id(),
                 "event_data": {
                     "event_name": "Long Queue Length",
@@ -443,7 +629,7 @@ class Mapper:
                 }
             })
             self._write({
-                "timestamp": iso_now(),
+                "timestamp": ts,
                 "event_id": self._next_id(),
                 "event_data": {
                     "event_name": "Staffing Needs",
@@ -452,7 +638,7 @@ class Mapper:
                 }
             })
             self._write({
-                "timestamp": iso_now(),
+                "timestamp": ts,
                 "event_id": self._next_id(),
                 "event_data": {
                     "event_name": "Checkout Station Action",
@@ -463,7 +649,7 @@ class Mapper:
 
         if dt >= 120:
             self._write({
-                "timestamp": iso_now(),
+                "timestamp": ts,
                 "event_id": self._next_id(),
                 "event_data": {
                     "event_name": "Long Wait Time",
@@ -472,25 +658,39 @@ class Mapper:
                 }
             })
 
-    def _parse_sku(self, reason, prefix="PRD_"):
-        m = re.search(r"(PRD_[A-Z]_\d+|PRD_\w+)", reason or "")
-        return m.group(1) if m else None
-
 # ----------------------------
 # Part 3: TCP client (consumer loop)
 # ----------------------------
 def readlines(sock: socket.socket):
-    buff = ""
+    # Buffered reader does the line splitting in C; no per-chunk string rebuilds.
     sock.settimeout(10.0)
-    while True:
-        chunk = sock.recv(4096).decode("utf-8", errors="ignore")
-        if not chunk:
-            break
-        buff += chunk
-        while "\n" in buff:
-            line, buff = buff.split("\n", 1)
+    with sock.makefile("rb", buffering=1 << 16) as stream:
+        for line in stream:
             if line.strip():
-                yield line.strip()
+                yield line
+
+_ID_FIELDS = ("sku", "predicted_product")
+_NUMERIC_FIELDS = ("weight_g", "expected_weight", "accuracy")
+
+def ingest_event(evt: dict) -> str:
+    """Validate and intern an incoming event in place; returns the station id.
+
+    Numeric fields are coerced to float (or None) once here, so FusionEngine can
+    compare them without guarding against wire data. Station ids and SKUs key
+    every state dict and window comparison, so interned copies hash once and
+    compare by identity, and repeated SKUs share one string.
+    """
+    data = evt.get("data")
+    if isinstance(data, dict):
+        for key in _ID_FIELDS:
+            value = data.get(key)
+            if type(value) is str:
+                data[key] = sys.intern(value)
+        for key in _NUMERIC_FIELDS:
+            if key in data:
+                data[key] = to_float_or_none(data[key])
+    station = evt.get("station_id", "SCC?")
+    return sys.intern(station) if type(station) is str else station
 
 def consume_once(host, port, products_csv: Path, out_file: Path):
     fusion = FusionEngine(products_csv=products_csv)
@@ -499,48 +699,72 @@ def consume_once(host, port, products_csv: Path, out_file: Path):
     s = socket.create_connection((host, port))
     print(f"[consumer] Connected to {host}:{port}")
 
-    frames = 0
-    for raw in readlines(s):
-        try:
-            frame = json.loads(raw)
-        except json.JSONDecodeError:
-            continue
-
-        # Skip banner
-        if isinstance(frame, dict) and "service" in frame:
-            print(f"[server] datasets={frame.get('datasets')} speed={frame.get('speed_factor')}")
-            continue
-
-        ds = (frame.get("dataset") or "").lower()
-        evt = frame.get("event") or {}
-        station = evt.get("station_id", "SCC?")
-
-        if "pos_transactions" in ds:
-            fusion.push_pos(station, evt.get("data") or {}, status=evt.get("status"))
-            result = fusion.compute(station)
-            mapper.maybe_status(station, "POS_Transactions", evt.get("status"))
-            mapper.from_fusion(station, result, fusion.last_pos(station))
-
-        elif "rfid_data" in ds or "rfid_readings" in ds:
-            fusion.push_rfid(station, evt.get("data") or {})
-
-        elif "product_recognism" in ds or "product_recognition" in ds:
-            fusion.push_vision(station, evt.get("data") or {}, status=evt.get("status"))
-            result = fusion.compute(station)
-            mapper.maybe_status(station, "Product_recognism", evt.get("status"))
-            mapper.from_fusion(station, result, fusion.last_pos(station))
-
-        elif "queue_monitor" in ds:
-            fusion.set_queue(station, evt.get("data") or {})
-            mapper.from_queue(station, fusion.get_queue(station))
+    def handle_pos(station, evt):
+        fusion.push_pos(station, evt.get("data") or {}, status=evt.get("status"))
+        result = fusion.compute(station)
+        mapper.maybe_status(station, "POS_Transactions", evt.get("status"))
+        mapper.from_fusion(station, result, fusion.last_pos(station))
+
+    def handle_rfid(station, evt):
+        fusion.push_rfid(station, evt.get("data") or {})
+
+    def handle_vision(station, evt):
+        fusion.push_vision(station, evt.get("data") or {}, status=evt.get("status"))
+        result = fusion.compute(station)
+        mapper.maybe_status(station, "Product_recognism", evt.get("status"))
+        mapper.from_fusion(station, result, fusion.last_pos(station))
+
+    def handle_queue(station, evt):
+        fusion.set_queue(station, evt.get("data") or {})
+        mapper.from_queue(station, fusion.get_queue(station))
+
+    def handle_inventory(station, evt):
+        # optional: diff snapshots here and call mapper.inventory_discrepancy(...)
+        pass
+
+    handlers = {
+        DATASET_TAGS["POS_Transactions"]: handle_pos,
+        DATASET_TAGS["RFID_data"]: handle_rfid,
+        DATASET_TAGS["Product_recognism"]: handle_vision,
+        DATASET_TAGS["Queue_monitor"]: handle_queue,
+        DATASET_TAGS["Current_inventory_data"]: handle_inventory,
+    }
+    # Frames without "dataset_tag" (e.g. from stream_server.py) dispatch on the dataset name.
+    handlers_by_name = {name: handlers[tag] for name, tag in DATASET_TAGS.items()}
+    handlers_by_name.update({stem: handlers_by_name[name] for name, stem in DATASET_ALIASES.items()})
+    unknown = set()
 
-        elif "current_inventory_data" in ds or "inventory_snapshots" in ds:
-            # optional: diff snapshots here and call mapper.inventory_discrepancy(...)
-            pass
-
-        frames += 1
+    frames = 0
+    try:
+        for raw in readlines(s):
+            try:
+                frame = loads(raw)
+            except json.JSONDecodeError:
+                continue
+
+            # Skip banner
+            if isinstance(frame, dict) and "service" in frame:
+                print(f"[server] datasets={frame.get('datasets')} speed={frame.get('speed_factor')}")
+                continue
+
+            evt = frame.get("event") or {}
+            tag = frame.get("dataset_tag")
+            if tag is not None:
+                handler = handlers.get(tag)
+            else:
+                handler = handlers_by_name.get(frame.get("dataset"))
+            if handler is not None:
+                handler(ingest_event(evt), evt)
+                mapper.flush_batch()
+            elif (tag, frame.get("dataset")) not in unknown:
+                unknown.add((tag, frame.get("dataset")))
+                print(f"[consumer] Ignoring frames from unknown dataset {frame.get('dataset')!r} (tag={tag})")
+
+            frames += 1
+    finally:
+        s.close()
+        mapper.close()
 
-    s.close()
     print(f"[consumer] Stream closed. Frames processed: {frames}")
     print(f"[consumer] Events written -> {out_file}")
 
@@ -592,6 +816,7 @@ def main():
     finally:
         try:
             srv.shutdown()
+            srv.server_close()
         except Exception:
             pass
 